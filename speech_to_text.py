@@ -1,73 +1,141 @@
 import os
-import sys
 import json
+import orjson
 import argparse
-import tempfile
 import traceback
+import threading
+import multiprocessing
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime  # Added this import
+from types import MappingProxyType
 from vosk import Model, KaldiRecognizer
-import wave
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
 from pydub import AudioSegment
-from phonemizer import phonemize
-from difflib import SequenceMatcher
+from phonemizer.backend import EspeakBackend
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import Levenshtein
 
 # Configuration
 DEBUG = True
 MIN_AUDIO_LENGTH_MS = 500
 SAMPLE_RATE = 16000
+BACKEND_WARMUP_TIMEOUT_S = 30  # max wait for the background espeak start-up
+CHUNK_BYTES = 64000  # 32000 PCM16 frames (2 s) fed to the recognizer per call
 
-# Supported languages
-SUPPORTED_LANGUAGES = {
+# Supported languages (read-only; shared by every call)
+SUPPORTED_LANGUAGES = MappingProxyType({
     'en': 'en-us',
     'fr': 'fr',
     'de': 'de',
     'nl': 'nl',
     'ko': 'ko'
-}
+})
 
-LANGUAGE_TIPS = {
-    'fr': ["Nasal vowels...", "Final consonants...", "French 'r'..."],
-    'de': ["Consonants clearly...", "Vowel length...", "'ch' sounds..."],
-    'nl': ["Guttural 'g'...", "Vowel length...", "'ui' diphthong..."],
-    'ko': ["Tense consonants...", "Vowel combinations...", "Even syllables..."],
-    'en': ["Stress syllables...", "Vowel sounds...", "Final consonants..."]
-}
+# Vosk model directories under vosk_models/ per language and size tier:
+# 'large' is vosk_models/<dir>, 'small' is vosk_models/small-<dir>, where <dir>
+# is the SUPPORTED_LANGUAGES value. Small models decode faster at some accuracy cost
+MODEL_SIZES = ('small', 'large')
+MODEL_DIRS = MappingProxyType({
+    lang_code: MappingProxyType({'small': f"small-{model_dir}", 'large': model_dir})
+    for lang_code, model_dir in SUPPORTED_LANGUAGES.items()
+})
 
-def debug_log(message):
-    if DEBUG:
+LANGUAGE_TIPS = MappingProxyType({
+    'fr': ("Nasal vowels...", "Final consonants...", "French 'r'..."),
+    'de': ("Consonants clearly...", "Vowel length...", "'ch' sounds..."),
+    'nl': ("Guttural 'g'...", "Vowel length...", "'ui' diphthong..."),
+    'ko': ("Tense consonants...", "Vowel combinations...", "Even syllables..."),
+    'en': ("Stress syllables...", "Vowel sounds...", "Final consonants...")
+})
+
+COMMON_PHRASES = MappingProxyType({
+    'fr': ("bonjour", "comment ça va", "je m'appelle"),
+    'de': ("hallo", "wie geht's", "mein name ist"),
+    'nl': ("hallo", "hoe gaat het", "mijn naam is"),
+    'ko': ("안녕하세요", "이름이 뭐예요", "감사합니다"),
+    'en': ("hello", "how are you", "my name is")
+})
+
+_COMMON_TOKENS = MappingProxyType({
+    lang: tuple(tuple(phrase.split()) for phrase in phrases)
+    for lang, phrases in COMMON_PHRASES.items()
+})
+
+# Log banners, formatted once at import
+_BANNER_START = f"{' Starting Analysis ':=^50}"
+_BANNER_COMPLETE = f"{' Analysis Complete ':=^50}"
+_BANNER_ERROR = f"{' ERROR ':=^50}"
+
+# Bound once at import so disabled logging costs a single no-op call;
+# call sites pass %-style args so formatting is deferred as well
+if DEBUG:
+    def debug_log(message, *args):
         timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-        print(f"[{timestamp}] {message}")
+        print(f"[{timestamp}] {message % args if args else message}")
+else:
+    def debug_log(message, *args):
+        pass
 
 def validate_audio(audio_path):
-    debug_log(f"Validating audio file: {audio_path}")
+    debug_log("Validating audio file: %s", audio_path)
     
     if not os.path.exists(audio_path):
         raise FileNotFoundError(f"Audio file not found: {audio_path}")
     
     try:
-        audio = AudioSegment.from_file(audio_path)
-        debug_log(f"Audio info - Duration: {len(audio)}ms, Channels: {audio.channels}, Sample rate: {audio.frame_rate}Hz")
+        # Only the header is read here; samples are decoded in convert_audio.
+        # Formats libsndfile cannot open are decoded by pydub, and the decoded
+        # audio is returned so convert_audio does not run ffmpeg again
+        decoded = None
+        try:
+            info = sf.info(audio_path)
+            duration_ms = int(info.duration * 1000)
+            channels, sample_rate = info.channels, info.samplerate
+        except RuntimeError:
+            decoded = AudioSegment.from_file(audio_path)
+            duration_ms = len(decoded)
+            channels, sample_rate = decoded.channels, decoded.frame_rate
+        debug_log("Audio info - Duration: %dms, Channels: %d, Sample rate: %dHz",
+                  duration_ms, channels, sample_rate)
         
-        if len(audio) < MIN_AUDIO_LENGTH_MS:
+        if duration_ms < MIN_AUDIO_LENGTH_MS:
             raise ValueError(f"Audio too short (minimum {MIN_AUDIO_LENGTH_MS}ms required)")
             
-        return audio
+        return decoded
     except Exception as e:
         raise ValueError(f"Audio validation failed: {str(e)}")
 
-def convert_audio(audio):
+def _segment_to_pcm(audio):
+    audio = audio.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2)
+    return np.frombuffer(audio.raw_data, dtype=np.int16)
+
+def convert_audio(audio_path, decoded=None):
     try:
-        debug_log("Converting audio to 16kHz mono...")
-        return audio.set_channels(1).set_frame_rate(SAMPLE_RATE)
+        debug_log("Converting audio to 16kHz mono PCM16...")
+        if decoded is not None:
+            return _segment_to_pcm(decoded)
+        try:
+            samples, sample_rate = sf.read(audio_path, dtype='int16')
+        except RuntimeError as e:
+            # ffmpeg fallback for formats libsndfile cannot open (M4A/AAC, WebM, older MP3)
+            debug_log("soundfile cannot decode audio (%s), falling back to pydub", e)
+            return _segment_to_pcm(AudioSegment.from_file(audio_path))
+        audio = samples.mean(axis=1) if samples.ndim > 1 else samples
+        if sample_rate != SAMPLE_RATE:
+            audio = resample_poly(audio, SAMPLE_RATE, sample_rate)
+        return np.clip(audio, -32768, 32767).astype(np.int16)
     except Exception as e:
         raise ValueError(f"Audio conversion failed: {str(e)}")
 
-def load_model(language):
-    lang_code = language if language in SUPPORTED_LANGUAGES else 'en'
-    model_dir = SUPPORTED_LANGUAGES[lang_code]
-    model_path = os.path.join("vosk_models", model_dir)
+@lru_cache(maxsize=len(SUPPORTED_LANGUAGES) * len(MODEL_SIZES))
+def _get_model(lang_code, size):
+    # Exceptions are not memoized by lru_cache, so a failed load is retried
+    model_path = os.path.join("vosk_models", MODEL_DIRS[lang_code][size])
     
-    debug_log(f"Loading model for {language} from: {model_path}")
+    debug_log("Loading %s model for %s from: %s", size, lang_code, model_path)
     
     if not os.path.exists(model_path):
         raise ValueError(f"Model directory not found: {model_path}")
@@ -79,68 +147,109 @@ def load_model(language):
     except Exception as e:
         raise ValueError(f"Model loading failed: {str(e)}")
 
+def load_model(language, size='large'):
+    lang_code = language if language in SUPPORTED_LANGUAGES else 'en'
+    if size not in MODEL_SIZES:
+        raise ValueError(f"Unknown model size: {size}")
+    return _get_model(lang_code, size)
+
+_recognizers = threading.local()
+
+def _get_recognizer(model):
+    # A KaldiRecognizer holds decoding state, so each thread keeps its own per
+    # model; the Model itself is safe to share
+    cache = getattr(_recognizers, 'by_model', None)
+    if cache is None:
+        cache = _recognizers.by_model = {}
+    recognizer = cache.get(model)
+    if recognizer is None:
+        recognizer = cache[model] = KaldiRecognizer(model, SAMPLE_RATE)
+        recognizer.SetWords(True)
+    return recognizer
+
 def recognize_speech(audio, model):
     try:
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_wav:
-            temp_path = tmp_wav.name
-            debug_log(f"Creating temporary WAV at: {temp_path}")
-            audio.export(temp_path, format="wav")
-            
-            recognizer = KaldiRecognizer(model, SAMPLE_RATE)
-            recognizer.SetWords(True)
-            
-            results = []
-            with wave.open(temp_path, 'rb') as wf:
-                debug_log("Starting speech recognition...")
-                while True:
-                    data = wf.readframes(4000)
-                    if len(data) == 0:
-                        break
-                    if recognizer.AcceptWaveform(data):
-                        result = json.loads(recognizer.Result())
-                        results.append(result.get('text', ''))
-                
-                final = json.loads(recognizer.FinalResult())
-                if final.get('text'):
-                    results.append(final.get('text', ''))
-            
-            recognized_text = " ".join(results).strip()
-            debug_log(f"Recognized text: '{recognized_text}'")
-            
-            return recognized_text
-            
+        pcm = audio.tobytes()
+        
+        recognizer = _get_recognizer(model)
+        recognizer.Reset()
+        
+        results = []
+        debug_log("Starting speech recognition...")
+        for i in range(0, len(pcm), CHUNK_BYTES):
+            if recognizer.AcceptWaveform(pcm[i:i + CHUNK_BYTES]):
+                result = orjson.loads(recognizer.Result())
+                results.append(result.get('text', ''))
+        
+        final = orjson.loads(recognizer.FinalResult())
+        if final.get('text'):
+            results.append(final.get('text', ''))
+        
+        recognized_text = " ".join(results).strip()
+        debug_log("Recognized text: '%s'", recognized_text)
+        
+        return recognized_text
+        
     except Exception as e:
         raise ValueError(f"Speech recognition failed: {str(e)}")
+
+def get_reference_text(recognized_words, lang_code, recognized_text):
+    # recognized_words are lowercased by the caller; recognized_text is the
+    # original transcript, returned unchanged when no phrase matches
+    lang = lang_code if lang_code in COMMON_PHRASES else 'en'
+    # Phrases are pre-split, so the word lists are compared directly;
+    # processor=None explicitly: rapidfuzz < 3.0 defaults to default_process,
+    # which rejects a list query
+    match = process.extractOne(recognized_words, _COMMON_TOKENS[lang], scorer=fuzz.ratio,
+                               processor=None, score_cutoff=70)
+    return COMMON_PHRASES[lang][match[2]] if match else recognized_text
+
+@lru_cache(maxsize=len(SUPPORTED_LANGUAGES))
+def _get_backend(lang_code):
+    # The backend keeps espeak loaded, so only the first call per language pays startup
+    return EspeakBackend(language=SUPPORTED_LANGUAGES[lang_code], preserve_punctuation=False)
+
+# espeak-ng keeps global translator state and is not reentrant, so calls into
+# each shared backend are serialized
+_backend_locks = {lang_code: threading.Lock() for lang_code in SUPPORTED_LANGUAGES}
+
+_backend_warmups = {}
+_backend_warmups_lock = threading.Lock()
+
+def _load_backend(lang_code, ready):
+    try:
+        _get_backend(lang_code)
+    except Exception as e:
+        debug_log("Phonemizer warm-up failed: %s", e)
     finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-            debug_log("Removed temporary WAV file")
+        ready.set()
 
-def get_reference_text(recognized_text, lang_code):
-    COMMON_PHRASES = {
-        'fr': ["bonjour", "comment ça va", "je m'appelle"],
-        'de': ["hallo", "wie geht's", "mein name ist"],
-        'nl': ["hallo", "hoe gaat het", "mijn naam is"],
-        'ko': ["안녕하세요", "이름이 뭐예요", "감사합니다"],
-        'en': ["hello", "how are you", "my name is"]
-    }
-    
-    words = recognized_text.lower().split()
-    for phrase in COMMON_PHRASES.get(lang_code, COMMON_PHRASES['en']):
-        phrase_words = phrase.split()
-        if SequenceMatcher(None, words, phrase_words).ratio() > 0.7:
-            return phrase
-    return recognized_text
+def _warm_backend(lang_code):
+    # Starts espeak at most once per language on a daemon thread, so a one-shot
+    # run that never phonemizes does not wait for it at exit
+    with _backend_warmups_lock:
+        if lang_code not in _backend_warmups:
+            ready = _backend_warmups[lang_code] = threading.Event()
+            threading.Thread(target=_load_backend, args=(lang_code, ready), daemon=True).start()
 
-def detect_mistakes(recognized_text, reference_text, lang_code):
-    recognized_words = recognized_text.lower().split()
-    reference_words = reference_text.lower().split()
-    
+@lru_cache(maxsize=1024)
+def _phonemize_pair(recognized_text, reference_text, lang_code):
+    # One backend call for both texts; reference phrases come from the small
+    # COMMON_PHRASES set, so repeated utterances are served from this cache
+    ready = _backend_warmups.get(lang_code)
+    if ready is not None and not ready.wait(BACKEND_WARMUP_TIMEOUT_S):
+        debug_log("Phonemizer warm-up still running, loading %s backend directly", lang_code)
+    # A failed or timed-out warm-up is retried (and reported) here
+    backend = _get_backend(lang_code)
+    with _backend_locks[lang_code]:
+        return tuple(backend.phonemize([recognized_text, reference_text], strip=True, njobs=1))
+
+def detect_mistakes(recognized_words, reference_words, lang_code, recognized_text, reference_text):
     mistakes = []
     corrected_words = []
-    matcher = SequenceMatcher(None, recognized_words, reference_words)
     
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    for op in Levenshtein.opcodes(recognized_words, reference_words):
+        tag, i1, i2, j1, j2 = op.tag, op.src_start, op.src_end, op.dest_start, op.dest_end
         if tag in ('replace', 'delete'):
             for i in range(i1, i2):
                 if i < len(recognized_words):
@@ -165,33 +274,42 @@ def detect_mistakes(recognized_text, reference_text, lang_code):
         elif tag == 'equal':
             corrected_words.extend(recognized_words[i1:i2])
     
-    if lang_code in ['en', 'fr', 'de', 'nl', 'ko']:
+    # Phonemes only relabel existing word mistakes, so skip espeak when the
+    # word alignment is already (near) perfect
+    if not mistakes or fuzz.ratio(recognized_words, reference_words) / 100 > 0.95:
+        return mistakes, " ".join(corrected_words)
+    
+    if lang_code in SUPPORTED_LANGUAGES:
         try:
-            recognized_phonemes = phonemize(recognized_text, language=lang_code, 
-                                          backend='espeak', strip=True, preserve_punctuation=False)
-            reference_phonemes = phonemize(reference_text, language=lang_code,
-                                         backend='espeak', strip=True, preserve_punctuation=False)
+            recognized_phonemes, reference_phonemes = _phonemize_pair(
+                recognized_text, reference_text, lang_code)
             
-            if SequenceMatcher(None, recognized_phonemes.split(), reference_phonemes.split()).ratio() < 0.85:
+            if fuzz.ratio(recognized_phonemes.split(), reference_phonemes.split()) / 100 < 0.85:
                 for mistake in mistakes:
                     if mistake["type"] == "incorrect_word":
                         mistake["type"] = "pronunciation"
         except Exception as e:
-            debug_log(f"Phonemization failed: {str(e)}")
+            debug_log("Phonemization failed: %s", e)
     
     return mistakes, " ".join(corrected_words)
 
 def generate_feedback(mistakes, lang_code):
     feedback = []
+    tips = LANGUAGE_TIPS.get(lang_code, LANGUAGE_TIPS['en'])
     
     if not mistakes:
         feedback.append("Excellent pronunciation! No mistakes detected.")
-        feedback.extend(LANGUAGE_TIPS.get(lang_code, LANGUAGE_TIPS['en'])[:2])
+        feedback.extend(tips[:2])
         return feedback
     
-    pronunciation_errors = [m for m in mistakes if m["type"] == "pronunciation"]
-    word_errors = [m for m in mistakes if m["type"] == "incorrect_word"]
-    extra_words = [m for m in mistakes if m["type"] == "extra_word"]
+    pronunciation_errors, word_errors, extra_words = [], [], []
+    for m in mistakes:
+        if m["type"] == "pronunciation":
+            pronunciation_errors.append(m)
+        elif m["type"] == "incorrect_word":
+            word_errors.append(m)
+        elif m["type"] == "extra_word":
+            extra_words.append(m)
     
     if pronunciation_errors:
         feedback.append(f"Pronunciation issues ({len(pronunciation_errors)}):")
@@ -210,15 +328,16 @@ def generate_feedback(mistakes, lang_code):
         feedback.append(f"Extra words detected ({len(extra_words)})")
     
     feedback.append("\nTips for improvement:")
-    feedback.extend(LANGUAGE_TIPS.get(lang_code, LANGUAGE_TIPS['en']))
+    feedback.extend(tips)
     
     return feedback
 
 def calculate_score(recognized_text, reference_text, mistakes):
+    # Both texts are expected to be lowercased by the caller
     if not reference_text:
         return 0
     
-    similarity = SequenceMatcher(None, recognized_text.lower(), reference_text.lower()).ratio()
+    similarity = fuzz.ratio(recognized_text, reference_text) / 100
     base_score = similarity * 100
     
     penalty = sum(
@@ -229,35 +348,46 @@ def calculate_score(recognized_text, reference_text, mistakes):
     
     return max(0, min(100, base_score - min(penalty, 40)))
 
-def analyze_pronunciation(audio_path, language='en'):
+def analyze_pronunciation(audio_path, language='en', model_size='large'):
     try:
-        debug_log(f"\n{' Starting Analysis ':=^50}")
-        debug_log(f"Language: {language}")
-        debug_log(f"Audio path: {audio_path}")
+        debug_log("\n%s", _BANNER_START)
+        debug_log("Language: %s", language)
+        debug_log("Audio path: %s", audio_path)
         
-        audio = validate_audio(audio_path)
-        processed_audio = convert_audio(audio)
-        model = load_model(language)
+        decoded = validate_audio(audio_path)
+        processed_audio = convert_audio(audio_path, decoded)
+        model = load_model(language, model_size)
         
+        # Start the espeak backend while Vosk decodes; only _phonemize_pair
+        # waits for it, and only if detect_mistakes gets as far as phonemizing
+        if language in SUPPORTED_LANGUAGES:
+            _warm_backend(language)
         recognized_text = recognize_speech(processed_audio, model)
         
         if not recognized_text:
             return {
                 "error": "No speech detected",
                 "debug": {
-                    "duration_ms": len(processed_audio),
-                    "sample_rate": processed_audio.frame_rate,
-                    "channels": processed_audio.channels
+                    "duration_ms": len(processed_audio) * 1000 // SAMPLE_RATE,
+                    "sample_rate": SAMPLE_RATE,
+                    "channels": 1
                 }
             }
         
-        reference_text = get_reference_text(recognized_text, language)
-        mistakes, corrected_text = detect_mistakes(recognized_text, reference_text, language)
+        recognized_lower = recognized_text.lower()
+        recognized_words = recognized_lower.split()
+        
+        reference_text = get_reference_text(recognized_words, language, recognized_text)
+        reference_lower = reference_text.lower()
+        reference_words = reference_lower.split()
+        
+        mistakes, corrected_text = detect_mistakes(recognized_words, reference_words, language,
+                                                   recognized_lower, reference_lower)
         feedback = generate_feedback(mistakes, language)
-        score = calculate_score(recognized_text, reference_text, mistakes)
+        score = calculate_score(recognized_lower, reference_lower, mistakes)
         
-        debug_log(f"{' Analysis Complete ':=^50}")
-        debug_log(f"Score: {score}")
+        debug_log(_BANNER_COMPLETE)
+        debug_log("Score: %s", score)
         
         return {
             "original_text": recognized_text,
@@ -279,24 +409,42 @@ def analyze_pronunciation(audio_path, language='en'):
         
         if DEBUG:
             error_info["traceback"] = traceback.format_exc()
-            debug_log(f"{' ERROR ':=^50}")
+            debug_log(_BANNER_ERROR)
             debug_log(json.dumps(error_info, indent=2))
         
         return error_info
 
+def _warm(language, model_size):
+    # Load the model once per worker; failures are reported per file by analyze_pronunciation
+    try:
+        load_model(language, model_size)
+    except Exception as e:
+        debug_log("Model warm-up failed: %s", e)
+
+def analyze_batch(paths, language='en', model_size='large', workers=None):
+    # Spawned workers start clean instead of forking a parent that may hold
+    # loaded models and running warm-up threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_warm, initargs=(language, model_size)) as ex:
+        return list(ex.map(partial(analyze_pronunciation, language=language,
+                                   model_size=model_size), paths))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="APMD Pronunciation Analyzer")
     parser.add_argument('--audio', required=True, help="Path to audio file")
     parser.add_argument('--language', default='en', choices=SUPPORTED_LANGUAGES.keys())
+    parser.add_argument('--model-size', default='large', choices=MODEL_SIZES,
+                        help="Vosk model tier: 'large' loads vosk_models/<lang>, 'small' loads "
+                             "vosk_models/small-<lang> (e.g. small-en-us) and trades accuracy for speed")
     parser.add_argument('--output', help="Output JSON file path")
     
     args = parser.parse_args()
     
-    result = analyze_pronunciation(args.audio, args.language)
+    result = analyze_pronunciation(args.audio, args.language, args.model_size)
     
     if args.output:
         with open(args.output, 'w') as f:
             json.dump(result, f, indent=2)
-        debug_log(f"Results saved to {args.output}")
+        debug_log("Results saved to %s", args.output)
     else:
         print(json.dumps(result, indent=2))
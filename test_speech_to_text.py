@@ -0,0 +1,97 @@
+from difflib import SequenceMatcher
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+for _module in ("scipy", "rapidfuzz", "pydub", "vosk", "phonemizer"):
+    pytest.importorskip(_module)
+
+from scipy.signal import resample_poly
+from rapidfuzz.distance import Levenshtein
+
+import speech_to_text as stt
+
+
+def _first_match_over_07(words, phrases):
+    # Phrase pick used before rapidfuzz: first phrase with ratio > 0.7
+    for phrase in phrases:
+        if SequenceMatcher(None, words, phrase.split()).ratio() > 0.7:
+            return phrase
+    return None
+
+
+def test_convert_audio_stereo_44k_to_mono_16k_without_wraparound(tmp_path):
+    rate = 44100
+    t = np.arange(rate) / rate
+    # Full-scale 50 Hz square wave; resampling overshoots past int16 at each edge
+    square = np.where(np.sin(2 * np.pi * 50 * t) >= 0, 32767, -32767).astype(np.int16)
+    path = tmp_path / "stereo.wav"
+    sf.write(str(path), np.column_stack([square, square]), rate, subtype='PCM_16')
+
+    out = stt.convert_audio(str(path))
+
+    assert out.dtype == np.int16
+    assert out.ndim == 1
+    assert abs(len(out) - stt.SAMPLE_RATE) <= 1
+
+    reference = resample_poly(square.astype(np.float64), stt.SAMPLE_RATE, rate)
+    assert reference.max() > 32767  # the overshoot that would wrap without clipping
+    loud = np.abs(reference) > 1000
+    assert np.array_equal(np.sign(out[loud]), np.sign(reference[loud]))
+
+
+@pytest.mark.parametrize("text", [
+    "how are you",
+    "how are",
+    "my name is john",
+    "hello there",
+    "something else entirely",
+])
+def test_get_reference_text_agrees_with_first_match_rule(text):
+    words = text.split()
+    expected = _first_match_over_07(words, stt.COMMON_PHRASES['en'])
+    assert stt.get_reference_text(words, 'en', text) == (expected or text)
+
+
+def test_get_reference_text_picks_best_match_and_accepts_exactly_70(monkeypatch):
+    phrases = ("a b c d", "a b c d e", "p q r s t u v w x y")
+    monkeypatch.setattr(stt, "COMMON_PHRASES", {'en': phrases})
+    monkeypatch.setattr(stt, "_COMMON_TOKENS", {'en': tuple(tuple(p.split()) for p in phrases)})
+
+    # The old rule stops at the first phrase over 0.7; extractOne takes the best one
+    words = "a b c d e".split()
+    assert _first_match_over_07(words, phrases) == "a b c d"
+    assert stt.get_reference_text(words, 'en', "a b c d e") == "a b c d e"
+
+    # 7 of 10 words shared in order: ratio is exactly 0.7, rejected before, accepted now
+    words = "p q r s t u v j k l".split()
+    assert _first_match_over_07(words, phrases) is None
+    assert stt.get_reference_text(words, 'en', "p q r s t u v j k l") == phrases[2]
+
+
+@pytest.mark.parametrize("recognized, reference", [
+    ("how are you", "how are you"),
+    ("how were you", "how are you"),
+    ("how are you today", "how are you"),
+    ("how you", "how are you"),
+    ("my name is bob", "my name is alice"),
+    ("hi my name", "my name is"),
+])
+def test_levenshtein_opcodes_match_difflib(recognized, reference):
+    recognized, reference = recognized.split(), reference.split()
+    ops = [(op.tag, op.src_start, op.src_end, op.dest_start, op.dest_end)
+           for op in Levenshtein.opcodes(recognized, reference)]
+    assert ops == SequenceMatcher(None, recognized, reference).get_opcodes()
+
+
+def test_detect_mistakes_counts_mismatched_run_like_difflib():
+    # difflib reports one 2-word replace here; Levenshtein splits it into
+    # replace + delete, which yields the same number of word mistakes
+    recognized, reference = "a b c x y", "a b c d"
+    # An unsupported language code keeps phonemization out of the test
+    mistakes, corrected = stt.detect_mistakes(recognized.split(), reference.split(), 'xx',
+                                              recognized, reference)
+    assert [m["word"] for m in mistakes] == ["x", "y"]
+    assert all(m["type"] == "incorrect_word" for m in mistakes)
+    assert corrected == "a b c d [silence]"